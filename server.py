@@ -3,17 +3,27 @@
 Taibai MCP Server - Dedao learning platform integration via dedao-dl
 """
 
+import asyncio
+import errno
+import http.client
 import json
 import os
 import re
 import shutil
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from typing import Literal
 
 from fastmcp import FastMCP
-from packaging import version
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 # Initialize MCP server
 mcp = FastMCP("taibai", version="0.3.0")
@@ -26,42 +36,72 @@ DEFAULT_VAULT_DIR = Path(os.getenv(
     HOME / "ideaverse-zero-2" / "Atlas" / "Sources" / "Dedao" / "Courses"
 ))
 
+VERSION_CACHE_FILE = TAIBAI_DIR / "version_cache.json"
+try:
+    VERSION_CACHE_TTL = int(os.getenv("TAIBAI_VERSION_CACHE_TTL", "86400"))
+except ValueError:
+    VERSION_CACHE_TTL = 86400  # Malformed override; fall back to 24h
+LATEST_RELEASE_URL = "https://api.github.com/repos/yann0917/dedao-dl/releases/latest"
+
+DEDAO_DL_MISSING = (
+    "dedao-dl is not installed. "
+    "Please install it first: go install github.com/yann0917/dedao-dl@latest"
+)
+NOT_LOGGED_IN = "Not logged in to Dedao. Please use dedao_login first."
+
+# dedao-dl "-t" output type codes
+COURSE_FORMAT_MAP = {"mp3": "1", "pdf": "2", "markdown": "3"}
+ARTICLE_FORMAT_MAP = {"pdf": "2", "markdown": "3"}
+
+# Seconds to reuse the cached authentication probe result
+PROBE_TTL = 60
+
+_VERSION_RE = re.compile(r'v(\d+\.\d+\.\d+)')
+
+# Output fragments dedao-dl prints when there is no valid session
+AUTH_ERROR_PATTERNS = ("请先登录", "未登录", "not login")
+
 # Ensure directories exist
 TAIBAI_DIR.mkdir(exist_ok=True)
 DEFAULT_VAULT_DIR.mkdir(parents=True, exist_ok=True)
 
 
 # Pydantic models for validation
-class LoginArgs(BaseModel):
-    qrcode: bool | None = Field(False, description="Login via QR code")
+class ToolArgs(BaseModel):
+    """Base for tool arguments: immutable, strict about unknown fields"""
+    model_config = ConfigDict(frozen=True, extra="forbid", str_strip_whitespace=True)
+
+
+class LoginArgs(ToolArgs):
+    qrcode: bool = Field(False, description="Login via QR code")
     cookie: str | None = Field(None, description="Login via cookie string")
 
 
-class ListCoursesArgs(BaseModel):
-    include_details: bool | None = Field(
+class ListCoursesArgs(ToolArgs):
+    include_details: bool = Field(
         False, description="Include detailed course information"
     )
 
 
-class CourseDetailsArgs(BaseModel):
+class CourseDetailsArgs(ToolArgs):
     course_id: str = Field(..., description="Course ID to get details for")
 
 
-class DownloadCourseArgs(BaseModel):
+class DownloadCourseArgs(ToolArgs):
     course_id: str = Field(..., description="Course ID to download")
-    format: Literal["pdf", "markdown", "mp3"] | None = Field(
+    format: Literal["pdf", "markdown", "mp3"] = Field(
         "markdown", description="Output format"
     )
     output_dir: str | None = Field(None, description="Output directory path")
 
 
-class ArticleDetailsArgs(BaseModel):
+class ArticleDetailsArgs(ToolArgs):
     article_id: str = Field(..., description="Article ID to get details for")
 
 
-class DownloadArticleArgs(BaseModel):
+class DownloadArticleArgs(ToolArgs):
     article_id: str = Field(..., description="Article ID to download")
-    format: Literal["pdf", "markdown"] | None = Field(
+    format: Literal["pdf", "markdown"] = Field(
         "markdown", description="Output format"
     )
     output_dir: str | None = Field(None, description="Output directory path")
@@ -77,66 +117,142 @@ class VersionInfo(BaseModel):
 
 
 
+# Absolute path of the dedao-dl binary (None = not found); resolved below
+_DEDAO_DL_PATH: str | None = None
+
+# Installed dedao-dl version keyed on (binary path, mtime_ns)
+_installed_versions: dict[tuple[str, int], str] = {}
+
+# Serializes downloads: every dedao-dl download writes to ~/.taibai/output
+_DOWNLOAD_LOCK = asyncio.Lock()
+
+
 # Helper functions
+def refresh_dedao_dl_path() -> str | None:
+    """Re-resolve the dedao-dl binary (e.g. after it was installed or moved)"""
+    global _DEDAO_DL_PATH
+    found = shutil.which(os.getenv("DEDAO_DL_PATH", "dedao-dl"))
+    # Absolute so a relative DEDAO_DL_PATH still resolves under cwd=TAIBAI_DIR
+    _DEDAO_DL_PATH = os.path.abspath(found) if found else None
+    return _DEDAO_DL_PATH
+
+
+refresh_dedao_dl_path()
+
+
 def check_dedao_dl() -> bool:
-    """Check if dedao-dl is installed"""
-    try:
-        subprocess.run(["dedao-dl", "--help"], capture_output=True, check=True)
-        return True
-    except (subprocess.CalledProcessError, FileNotFoundError):
-        return False
+    """Check if dedao-dl is installed (PATH is only re-scanned while missing)"""
+    return (_DEDAO_DL_PATH or refresh_dedao_dl_path()) is not None
 
 
 def get_dedao_dl_version() -> str | None:
-    """Get installed dedao-dl version using go version command"""
+    """Get installed dedao-dl version (cached until the binary changes)"""
+    binary_path = _DEDAO_DL_PATH or refresh_dedao_dl_path()
+    if not binary_path:
+        return None
+
     try:
-        # Find dedao-dl binary path
-        result = subprocess.run(
-            ["which", "dedao-dl"],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        binary_path = result.stdout.strip()
-        
-        # Get version info from Go binary
-        result = subprocess.run(
+        mtime_ns = os.stat(binary_path).st_mtime_ns
+    except OSError:
+        return None
+
+    # Only successful lookups are cached so a transient failure is retried
+    key = (binary_path, mtime_ns)
+    installed = _installed_versions.get(key)
+    if installed is None:
+        installed = _read_binary_version(binary_path)
+        if installed is not None:
+            _installed_versions.clear()
+            _installed_versions[key] = installed
+    return installed
+
+
+def _read_binary_version(binary_path: str) -> str | None:
+    """Extract the dedao-dl module version using go version command"""
+    try:
+        # Stream version info from Go binary; the module line is near the top
+        with subprocess.Popen(
             ["go", "version", "-m", binary_path],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        
-        # Extract version from output
-        for line in result.stdout.split('\n'):
-            if 'mod\tgithub.com/yann0917/dedao-dl' in line:
-                match = re.search(r'v(\d+\.\d+\.\d+)', line)
-                if match:
-                    return match.group(1)
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True
+        ) as proc:
+            for line in proc.stdout:
+                if 'mod\tgithub.com/yann0917/dedao-dl' in line:
+                    proc.terminate()
+                    match = _VERSION_RE.search(line)
+                    return match.group(1) if match else None
         return None
-    except (subprocess.CalledProcessError, FileNotFoundError):
+    except FileNotFoundError:
         return None
 
 
+def _load_version_cache() -> dict:
+    """Load the cached latest-release info ({} if missing or unreadable)"""
+    try:
+        data = json.loads(VERSION_CACHE_FILE.read_text())
+    except (OSError, ValueError):
+        return {}
+
+    # Ignore hand-edited or corrupt entries rather than failing the check
+    if (
+        not isinstance(data, dict)
+        or not isinstance(data.get("ts"), (int, float))
+        or not isinstance(data.get("version"), str)
+        or not isinstance(data.get("etag"), (str, type(None)))
+    ):
+        return {}
+    return data
+
+
+def _store_version_cache(latest: str, etag: str | None) -> None:
+    """Atomically persist the latest version and ETag with the current timestamp"""
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=TAIBAI_DIR, suffix=".tmp")
+    except OSError:
+        return  # Cache is best-effort
+
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump({"ts": time.time(), "version": latest, "etag": etag}, f)
+        os.replace(tmp_path, VERSION_CACHE_FILE)
+    except OSError:
+        Path(tmp_path).unlink(missing_ok=True)
+
+
 def get_latest_dedao_dl_version() -> str | None:
-    """Get latest dedao-dl version from GitHub releases"""
+    """Get latest dedao-dl version from GitHub releases (cached on disk)"""
+    cache = _load_version_cache()
+    cached = cache.get("version")
+    if cached and time.time() - cache["ts"] < VERSION_CACHE_TTL:
+        return cached
+
+    headers = {"Accept": "application/vnd.github+json"}
+    if cached and cache.get("etag"):
+        # Conditional request: 304 has no body and doesn't count against rate limit
+        headers["If-None-Match"] = cache["etag"]
+
     try:
-        result = subprocess.run(
-            ["gh", "api", "repos/yann0917/dedao-dl/releases/latest"],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        
-        # Extract tag_name from JSON response
-        data = json.loads(result.stdout)
-        tag = data.get('tag_name', '')
-        if tag.startswith('v'):
-            return tag[1:]  # Remove 'v' prefix
+        request = urllib.request.Request(LATEST_RELEASE_URL, headers=headers)
+        with urllib.request.urlopen(request, timeout=10) as response:
+            data = json.load(response)
+            etag = response.headers.get("ETag")
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and cached:
+            _store_version_cache(cached, cache.get("etag"))
+            return cached
         return None
-    except (subprocess.CalledProcessError, FileNotFoundError, json.JSONDecodeError):
+    except (OSError, ValueError, http.client.HTTPException):
         return None
 
+    # Extract tag_name from JSON response
+    tag = data.get('tag_name') if isinstance(data, dict) else None
+    if isinstance(tag, str) and tag.startswith('v'):
+        latest = tag[1:]  # Remove 'v' prefix
+        _store_version_cache(latest, etag)
+        return latest
+    return None
+
 
 def check_version_compatibility() -> tuple[bool, str]:
     """Check if dedao-dl version is up to date"""
@@ -150,70 +266,94 @@ def check_version_compatibility() -> tuple[bool, str]:
         # Can't check latest, assume compatible
         return True, f"Using dedao-dl v{installed}"
     
-    try:
-        from packaging import version
-        if version.parse(installed) < version.parse(latest):
-            return True, (
-                f"dedao-dl v{installed} is installed (latest: v{latest})\n"
-                f"Update with: go install github.com/yann0917/dedao-dl@latest"
-            )
-        else:
-            return True, f"Using dedao-dl v{installed} (up to date)"
-    except ImportError:
-        # Fallback to string comparison if packaging not available
-        if installed != latest:
-            return True, (
-                f"dedao-dl v{installed} is installed (latest: v{latest})\n"
-                f"Update with: go install github.com/yann0917/dedao-dl@latest"
-            )
-        return True, f"Using dedao-dl v{installed} (up to date)"
+    # packaging is a hard dependency; imported here to keep startup light
+    from packaging.version import parse
 
+    if parse(installed) < parse(latest):
+        return True, (
+            f"dedao-dl v{installed} is installed (latest: v{latest})\n"
+            f"Update with: go install github.com/yann0917/dedao-dl@latest"
+        )
+    return True, f"Using dedao-dl v{installed} (up to date)"
 
-def check_dedao_auth() -> bool:
-    """Check if authenticated with Dedao"""
+
+@lru_cache(maxsize=1)
+def _probe_auth(_ttl_bucket: int) -> bool:
+    """Probe authentication with a single 'dedao-dl who' call"""
     try:
-        subprocess.run(
-            ["dedao-dl", "who"],
+        result = subprocess.run(
+            [_DEDAO_DL_PATH or "dedao-dl", "who"],
             cwd=TAIBAI_DIR,
-            capture_output=True,
-            check=True
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
         )
-        return True
-    except subprocess.CalledProcessError:
+    except FileNotFoundError:
+        refresh_dedao_dl_path()
         return False
+    return result.returncode == 0
+
 
+def check_dedao_auth() -> bool:
+    """Check if authenticated with Dedao (cached for PROBE_TTL seconds)"""
+    return _probe_auth(int(time.monotonic() // PROBE_TTL))
 
-def execute_dedao_dl(
+
+async def execute_dedao_dl(
     args: list[str],
     interactive: bool = False,
     cwd: Path | None = None
 ) -> str:
-    """Execute dedao-dl command"""
+    """Execute dedao-dl command without blocking the event loop"""
     if not check_dedao_dl():
-        raise RuntimeError(
-            "dedao-dl is not installed. "
-            "Please install it first: go install github.com/yann0917/dedao-dl@latest"
-        )
+        raise RuntimeError(DEDAO_DL_MISSING)
 
     working_dir = cwd or TAIBAI_DIR
 
-    if interactive:
-        # Interactive mode for QR code login
-        result = subprocess.run(
-            ["dedao-dl"] + args,
-            cwd=working_dir,
-            text=True
-        )
-        return "Interactive command completed"
-    else:
-        result = subprocess.run(
-            ["dedao-dl"] + args,
-            cwd=working_dir,
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        return result.stdout
+    try:
+        if interactive:
+            # Interactive mode for QR code login
+            proc = await asyncio.create_subprocess_exec(
+                _DEDAO_DL_PATH or "dedao-dl", *args,
+                cwd=str(working_dir)
+            )
+        else:
+            proc = await asyncio.create_subprocess_exec(
+                _DEDAO_DL_PATH or "dedao-dl", *args,
+                cwd=str(working_dir),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+    except FileNotFoundError:
+        # Binary disappeared since it was resolved; re-check next time
+        refresh_dedao_dl_path()
+        raise RuntimeError(DEDAO_DL_MISSING) from None
+
+    try:
+        if interactive:
+            await proc.wait()
+            return "Interactive command completed"
+        stdout, stderr = await proc.communicate()
+    except BaseException:
+        # Don't leave dedao-dl running (e.g. on cancellation): it would keep
+        # writing to ~/.taibai/output after the download lock is released
+        if proc.returncode is None:
+            proc.kill()
+        await proc.wait()
+        raise
+
+    if proc.returncode == 0:
+        return stdout.decode(errors="replace")
+
+    output = (stderr or stdout).decode(errors="replace").strip()
+    # Only diagnose auth on failure, so the happy path costs a single spawn
+    if args[:1] != ["login"] and (
+        any(pattern in output for pattern in AUTH_ERROR_PATTERNS)
+        or not await asyncio.to_thread(check_dedao_auth)
+    ):
+        raise RuntimeError(NOT_LOGGED_IN)
+    raise RuntimeError(
+        f"dedao-dl exited with status {proc.returncode}: {output}"
+    )
 
 
 def move_downloaded_files(target_dir: Path) -> None:
@@ -223,21 +363,41 @@ def move_downloaded_files(target_dir: Path) -> None:
     if not source_dir.exists():
         return
 
+    # Fast path: a fresh target on the same filesystem is a single rename
+    if not target_dir.exists() and not target_dir.is_symlink():
+        target_dir.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.rename(source_dir, target_dir)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
     target_dir.mkdir(parents=True, exist_ok=True)
 
-    # Move all items from output directory
-    for item in source_dir.iterdir():
-        target_path = target_dir / item.name
+    # One scandir of the target replaces per-item exists()/is_dir() stats
+    with os.scandir(target_dir) as entries:
+        existing = {e.name: e.is_dir(follow_symlinks=False) for e in entries}
+
+    def _move_one(item: os.DirEntry) -> None:
+        target_path = os.path.join(target_dir, item.name)
 
         # Remove target if it exists
-        if target_path.exists():
-            if target_path.is_dir():
+        if item.name in existing:
+            if existing[item.name]:
                 shutil.rmtree(target_path)
             else:
-                target_path.unlink()
+                os.unlink(target_path)
 
         # Move item to target
-        shutil.move(str(item), str(target_path))
+        shutil.move(item.path, target_path)
+
+    # Move all items from output directory in parallel (I/O bound)
+    with (
+        os.scandir(source_dir) as items,
+        ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 4)) as ex,
+    ):
+        list(ex.map(_move_one, items))
 
     # Try to remove empty output directory
     try:
@@ -246,126 +406,117 @@ def move_downloaded_files(target_dir: Path) -> None:
         pass  # Directory not empty or doesn't exist
 
 
+async def download_and_move(cmd_args: list[str], output_dir: str | None) -> Path:
+    """Run a dedao-dl download and move the result to the target directory"""
+    target_dir = Path(output_dir) if output_dir else DEFAULT_VAULT_DIR
+
+    # Downloads share ~/.taibai/output, so run download-and-move one at a time
+    async with _DOWNLOAD_LOCK:
+        # Execute download (always from ~/.taibai for authentication)
+        await execute_dedao_dl(cmd_args)
+
+        # Move files to target directory
+        await asyncio.to_thread(move_downloaded_files, target_dir)
+
+    return target_dir
+
+
 # MCP Tools
 @mcp.tool()
-def dedao_version() -> str:
+async def dedao_version() -> str:
     """Check dedao-dl version and update status"""
     if not check_dedao_dl():
         return "dedao-dl is not installed. Install with: go install github.com/yann0917/dedao-dl@latest"
     
-    compatible, message = check_version_compatibility()
+    # Cheap on repeat calls: both version lookups are cached
+    compatible, message = await asyncio.to_thread(check_version_compatibility)
     return message
 
 
 @mcp.tool()
-def dedao_login(args: LoginArgs) -> str:
+async def dedao_login(args: LoginArgs) -> str:
     """Login to Dedao platform via QR code or cookie"""
     cmd_args = ["login"]
 
     if args.qrcode:
         cmd_args.append("-q")
-        execute_dedao_dl(cmd_args, interactive=True)
+        await execute_dedao_dl(cmd_args, interactive=True)
+        _probe_auth.cache_clear()
         return "QR code login completed. Please check if login was successful."
 
     if args.cookie:
         cmd_args.extend(["--cookie", args.cookie])
 
-    result = execute_dedao_dl(cmd_args)
+    result = await execute_dedao_dl(cmd_args)
+    _probe_auth.cache_clear()
     return result or "Login successful"
 
 
 @mcp.tool()
-def dedao_list_courses(args: ListCoursesArgs) -> str:
+async def dedao_list_courses(args: ListCoursesArgs) -> str:
     """List all purchased courses"""
-    if not check_dedao_auth():
-        raise RuntimeError("Not logged in to Dedao. Please use dedao_login first.")
-
     cmd_args = ["course"]
     if args.include_details:
         cmd_args.append("-d")
 
-    return execute_dedao_dl(cmd_args)
+    return await execute_dedao_dl(cmd_args)
 
 
 @mcp.tool()
-def dedao_course_details(args: CourseDetailsArgs) -> str:
+async def dedao_course_details(args: CourseDetailsArgs) -> str:
     """Get detailed information about a specific course"""
-    if not check_dedao_auth():
-        raise RuntimeError("Not logged in to Dedao. Please use dedao_login first.")
-
     cmd_args = ["detail", args.course_id]
-    return execute_dedao_dl(cmd_args)
+    return await execute_dedao_dl(cmd_args)
 
 
 @mcp.tool()
-def dedao_download_course(args: DownloadCourseArgs) -> str:
+async def dedao_download_course(args: DownloadCourseArgs) -> str:
     """Download a course in specified format"""
-    if not check_dedao_auth():
-        raise RuntimeError("Not logged in to Dedao. Please use dedao_login first.")
-
     cmd_args = ["dl", args.course_id]
 
-    # Format mapping
-    format_map = {"mp3": "1", "pdf": "2", "markdown": "3"}
-    if args.format:
-        cmd_args.extend(["-t", format_map[args.format]])
+    cmd_args.extend(("-t", COURSE_FORMAT_MAP[args.format]))
 
     # Include hot comments for community insights
     cmd_args.append("-c")
 
-    # Execute download (always from ~/.taibai for authentication)
-    execute_dedao_dl(cmd_args)
-
-    # Move files to target directory
-    target_dir = Path(args.output_dir) if args.output_dir else DEFAULT_VAULT_DIR
-    move_downloaded_files(target_dir)
-
+    target_dir = await download_and_move(cmd_args, args.output_dir)
     return f"Course {args.course_id} downloaded successfully to {target_dir}"
 
 
 @mcp.tool()
-def dedao_article_details(args: ArticleDetailsArgs) -> str:
+async def dedao_article_details(args: ArticleDetailsArgs) -> str:
     """Get detailed information about a specific article"""
-    if not check_dedao_auth():
-        raise RuntimeError("Not logged in to Dedao. Please use dedao_login first.")
-
     cmd_args = ["article", "detail", args.article_id]
-    return execute_dedao_dl(cmd_args)
+    return await execute_dedao_dl(cmd_args)
 
 
 @mcp.tool()
-def dedao_download_article(args: DownloadArticleArgs) -> str:
+async def dedao_download_article(args: DownloadArticleArgs) -> str:
     """Download an article in specified format"""
-    if not check_dedao_auth():
-        raise RuntimeError("Not logged in to Dedao. Please use dedao_login first.")
-
     cmd_args = ["article", "dl", args.article_id]
 
-    # Format mapping
-    format_map = {"pdf": "2", "markdown": "3"}
-    if args.format:
-        cmd_args.extend(["-t", format_map[args.format]])
+    cmd_args.extend(("-t", ARTICLE_FORMAT_MAP[args.format]))
 
-    # Execute download
-    execute_dedao_dl(cmd_args)
+    target_dir = await download_and_move(cmd_args, args.output_dir)
+    return f"Article {args.article_id} downloaded successfully to {target_dir}"
 
-    # Move files to target directory
-    target_dir = Path(args.output_dir) if args.output_dir else DEFAULT_VAULT_DIR
-    move_downloaded_files(target_dir)
 
-    return f"Article {args.article_id} downloaded successfully to {target_dir}"
 
 
+def _log_version_check() -> None:
+    """Run the startup version check and log its result"""
+    compatible, message = check_version_compatibility()
+    if message:
+        # stderr: stdout carries the MCP stdio transport once the server runs
+        print(f"[INFO] {message}", file=sys.stderr, flush=True)
 
 
 def main():
     """Main entry point for the MCP server"""
-    # Check version compatibility on startup
+    # Check version compatibility in the background so startup isn't blocked
     if check_dedao_dl():
-        compatible, message = check_version_compatibility()
-        if message:
-            print(f"[INFO] {message}", flush=True)
-    
+        threading.Thread(target=_log_version_check, daemon=True).start()
+
     # Run the MCP server
     mcp.run()
 